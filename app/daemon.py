@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import math
+import heapq
 import signal
 import asyncio
 import logging
@@ -16,7 +18,9 @@ logger = logging.getLogger(__name__)
 class Daemon:
     def __init__(self, loop, port, user, passwd, network, store, scan_interval,
                  scan_timeout, max_scans, offline_delay, index_interval, index_timeout,
-                 max_index_tasks, max_index_errors):
+                 max_index_tasks, max_index_errors, index_retry_interval,
+                 index_budget_duration, index_budget_dirs, index_checkpoint_interval,
+                 replica_interval):
         self.loop = loop
         self.port = port
         self.user = user
@@ -29,12 +33,25 @@ class Daemon:
         self.offline_delay = timedelta(seconds=offline_delay)
         self.index_interval = timedelta(seconds=index_interval)
         self.index_timeout = index_timeout
+        self.max_index_tasks = max_index_tasks
         self.max_index_errors = max_index_errors
+        self.index_retry_interval = timedelta(seconds=index_retry_interval)
+        self.index_budget_duration = index_budget_duration
+        self.index_budget_dirs = index_budget_dirs
+        self.index_checkpoint_interval = index_checkpoint_interval
+        self.replica_interval = timedelta(seconds=replica_interval)
 
         self.executor = ThreadPoolExecutor(max_workers=max_index_tasks)
+        self.publisher = ThreadPoolExecutor(max_workers=1) # not to wait for index tasks
         self.scheduled = {} # handle for addresses of servers scheduled for indexation
+        self.queue = [] # heap of (priority, count, address) of servers due for indexation
+        self.queued = set() # addresses of servers in self.queue
+        self.queue_count = 0 # tie breaker to keep the queue FIFO for equal priorities
+        self.dispatch_pending = False # whether self._dispatch is about to be called
         self.submitted = {} # future for addresses of servers about to be indexed
         self.busy = set() # addresses of servers being indexed
+        self.walkers = {} # walker for addresses of servers being indexed
+        self.paused = {} # pause date for servers with an unfinished indexation
         self.hosts = {} # host information for recently seen servers
         self.should_stop = False
 
@@ -45,7 +62,7 @@ class Daemon:
         return (yield from scanner.scan(self.network))
 
     def _submit_pruning(self):
-        future = self.executor.submit(self._prune)
+        future = self.loop.run_in_executor(self.executor, self._prune)
         future.add_done_callback(self._pruned)
 
     # Executed in a separate thread
@@ -59,14 +76,37 @@ class Daemon:
         logger.info('Pruning complete')
         self.loop.call_later(self.index_interval.seconds, self._submit_pruning)
 
+    def _submit_publishing(self):
+        future = self.loop.run_in_executor(self.publisher, self._publish)
+        future.add_done_callback(self._published)
+
+    # Executed in a separate thread
+    def _publish(self):
+        logger.info('Publishing of index replica started')
+        self.store.publish()
+
+    # Called when self._publish has finished
+    def _published(self, future):
+        try:
+            future.result()
+        except Exception as exc:
+            logger.exception('Exception while publishing index replica: %r', exc)
+        else:
+            logger.info('Publishing of index replica complete')
+        if not self.should_stop:
+            self.loop.call_later(self.replica_interval.seconds, self._submit_publishing)
+
     # Run for each host and in parallel depending on max_index_tasks.
     def _index(self, ip):
         logger.info('Start indexing %s', ip)
         walker = Walker(ip, self.port, self.user, self.passwd, self.index_timeout,
-                        self.max_index_errors, self.store.index_db())
-        self.loop.call_soon_threadsafe(self._mark_busy, ip) # avoid race condition
+                        self.max_index_errors, self.store.index_db(),
+                        max_duration=self.index_budget_duration,
+                        max_dirs=self.index_budget_dirs,
+                        checkpoint_interval=self.index_checkpoint_interval)
+        self.loop.call_soon_threadsafe(self._mark_busy, ip, walker) # avoid race condition
         try:
-            walker.walk()
+            complete = walker.walk()
         except TooManyErrors:
             logger.warning('Could not index %s: too many errors', ip)
             return { 'ip': ip, 'success': False }
@@ -74,21 +114,28 @@ class Daemon:
             logger.exception('Exception while indexing %s: %r', ip, exc)
             return { 'ip': ip, 'success': False }
         else:
+            if not complete:
+                return { 'ip': ip, 'success': True, 'paused': True }
             with self.store.index_db() as db:
                 stat = db.get_stat(ip)
             return { 'ip': ip, 'success': True,
                      'file_count': stat['file_count'], 'size': stat['size'] }
 
-    def _mark_busy(self, ip):
+    def _mark_busy(self, ip, walker):
         del self.submitted[ip]
         self.busy.add(ip)
+        self.walkers[ip] = walker
+        if self.should_stop: walker.stop()
 
     # Called when _index has finished.
     def _indexed(self, future):
+        if future.cancelled(): return # only happens when stopping
         result = future.result()
         ip = result['ip']
 
         self.busy.remove(ip)
+        del self.walkers[ip]
+        self._schedule_dispatch() # a slot has been freed
 
         try:
             info = self.hosts[ip]
@@ -96,10 +143,25 @@ class Daemon:
             logger.info('Finished indexing %s but it has been forgotten already', ip)
             return
 
+        if result.get('paused', False):
+            # Out of budget: let other servers be indexed before resuming this one.
+            self.paused[ip] = datetime.utcnow()
+            logger.info('Paused indexing %s', ip)
+            if info['online'] and not self.should_stop:
+                self._enqueue(ip)
+            return
+
         if result['success']:
+            self.paused.pop(ip, None)
             info['last_indexed'] = datetime.utcnow()
             info['file_count'] = result['file_count']
             info['size'] = result['size']
+            delay = self.index_interval.seconds
+        else:
+            # Like after a restart, it stays paused and resumes from its checkpoint, but
+            # not right away in case the server is having trouble.
+            self.paused[ip] = datetime.utcnow()
+            delay = self.index_retry_interval.seconds
 
         with self.store.scan_db() as db:
             db.set_hosts(self.hosts)
@@ -107,17 +169,56 @@ class Daemon:
         logger.info('Finished indexing %s', ip)
 
         if info['online'] and not self.should_stop:
-            delay = self.index_interval.seconds
-            self.scheduled[ip] = self.loop.call_later(delay, self._submit, ip)
+            self.scheduled[ip] = self.loop.call_later(delay, self._due, ip)
             logger.debug('Next indexation of %s in %d seconds', ip, delay)
 
-    def _submit(self, ip):
+    # Never indexed servers come first, then the ones with the most outdated index
+    # relative to their size, so that small servers are kept fresh without starving
+    # big ones.  Paused servers count as outdated since their pause, so that they
+    # resume once the servers waiting for longer have been indexed.
+    def _priority(self, ip):
+        info = self.hosts[ip]
+        if ip in self.paused:
+            since = self.paused[ip]
+        elif 'last_indexed' in info:
+            since = info['last_indexed']
+        else:
+            return (0, 0)
+        age = (datetime.utcnow() - since).total_seconds()
+        return (1, -age / math.log(math.e + info.get('file_count', 0)))
+
+    def _due(self, ip):
         del self.scheduled[ip]
-        if ip in self.hosts and self.hosts[ip]['online']:
-            logger.debug('Submit indexation of %s to tread pool', ip)
-            future = self.executor.submit(self._index, ip)
-            future.add_done_callback(self._indexed)
-            self.submitted[ip] = future
+        self._enqueue(ip)
+
+    def _enqueue(self, ip):
+        if ip not in self.queued:
+            heapq.heappush(self.queue, (self._priority(ip), self.queue_count, ip))
+            self.queue_count += 1
+            self.queued.add(ip)
+        self._schedule_dispatch()
+
+    # Dispatch on the next iteration of the loop, once all the servers due at the same
+    # time have been queued, so that the first of them does not get a slot regardless
+    # of its priority.
+    def _schedule_dispatch(self):
+        if not self.dispatch_pending:
+            self.dispatch_pending = True
+            self.loop.call_soon(self._dispatch)
+
+    # Submit queued servers to the thread pool by priority, without exceeding its size
+    # so that a server due later but with a higher priority can still jump the queue.
+    def _dispatch(self):
+        self.dispatch_pending = False
+        while self.queue and not self.should_stop \
+                and len(self.submitted) + len(self.busy) < self.max_index_tasks:
+            (_, _, ip) = heapq.heappop(self.queue)
+            self.queued.remove(ip)
+            if ip in self.hosts and self.hosts[ip]['online']:
+                logger.debug('Submit indexation of %s to tread pool', ip)
+                future = self.loop.run_in_executor(self.executor, self._index, ip)
+                future.add_done_callback(self._indexed)
+                self.submitted[ip] = future
 
     def _process(self, online_hosts):
         now = datetime.utcnow()
@@ -133,18 +234,20 @@ class Daemon:
         old = [ip for (ip, info) in self.hosts.items() if info['last_online'] < limit]
         for ip in old:
             del self.hosts[ip]
+            self.paused.pop(ip, None)
             logger.info('Forgot about %s', ip)
 
         # Schedule indexation for online hosts that are not already scheduled.
         for (ip, _) in online_hosts:
             info = self.hosts[ip]
-            if ip not in self.scheduled and ip not in self.submitted \
-                    and ip not in self.busy:
+            if ip not in self.scheduled and ip not in self.queued \
+                    and ip not in self.submitted and ip not in self.busy:
                 try:
-                    delay = (info['last_indexed'] + self.index_interval - now).seconds
+                    due = info['last_indexed'] + self.index_interval - now
+                    delay = 0 if ip in self.paused else max(0, int(due.total_seconds()))
                 except KeyError:
                     delay = 0
-                self.scheduled[ip] = self.loop.call_later(delay, self._submit, ip)
+                self.scheduled[ip] = self.loop.call_later(delay, self._due, ip)
                 logger.debug('Scheduled indexation of %s in %d seconds', ip, delay)
 
         # Update scan database
@@ -162,18 +265,35 @@ class Daemon:
         except asyncio.TimeoutError:
             pass
 
+    # Recover what is known about servers from the previous run, so that indexes are
+    # neither pruned nor needlessly redone on restart.
+    def _restore(self):
+        with self.store.scan_db() as db:
+            hosts = db.get_hosts()
+        self.hosts = { ip: dict({ k: v for (k, v) in info.items() if v is not None },
+                                online=False)
+                       for (ip, info) in hosts.items() }
+        with self.store.index_db() as db:
+            self.paused = { ip: datetime.utcnow() for ip in db.get_checkpoints() }
+
     @asyncio.coroutine
     def run(self):
+        self._restore()
         try:
             # Schedule database pruning
             self.loop.call_soon(self._submit_pruning)
 
+            # Schedule publishing of the read-only index replica for the web interface
+            if self.store.replica_file is not None:
+                self.loop.call_soon(self._submit_publishing)
+
             # Main loop: scan and sleep
             while not self.should_stop:
                 self._process((yield from self._scan()))
                 yield from self._sleep(self.scan_interval)
         finally:
             self.executor.shutdown()
+            self.publisher.shutdown()
 
     def stop(self, signame=None):
         logger.info('Received signal %s: stopping loop, this can take a while...'
@@ -186,7 +306,12 @@ class Daemon:
             logger.debug('Cancelled handle for %s: %s', ip, handle.cancel())
         for (ip, future) in self.submitted.items():
             logger.debug('Cancelled future for %s: %s', ip, future.cancel())
-        logger.debug('Still busy: %s', self.busy)
+        logger.debug('Dropped from queue: %s', self.queued)
+        self.queue.clear()
+        self.queued.clear()
+        for (ip, walker) in self.walkers.items():
+            logger.debug('Stopping walker for %s', ip)
+            walker.stop()
 
         self.should_stop = True
         if hasattr(self, 'sleep'): self.sleep.cancel()
@@ -204,7 +329,12 @@ def main():
                     scan_timeout=conf.SCAN_TIMEOUT, max_scans=conf.MAX_SCAN_TASKS,
                     offline_delay=conf.OFFLINE_DELAY, index_interval=conf.INDEX_INTERVAL,
                     index_timeout=conf.INDEX_TIMEOUT, max_index_tasks=conf.MAX_INDEX_TASKS,
-                    max_index_errors=conf.MAX_INDEX_ERRORS)
+                    max_index_errors=conf.MAX_INDEX_ERRORS,
+                    index_retry_interval=conf.INDEX_RETRY_INTERVAL,
+                    index_budget_duration=conf.INDEX_BUDGET_DURATION,
+                    index_budget_dirs=conf.INDEX_BUDGET_DIRS,
+                    index_checkpoint_interval=conf.INDEX_CHECKPOINT_INTERVAL,
+                    replica_interval=conf.REPLICA_INTERVAL)
     for name in conf.SOFT_SIGNALS:
         loop.add_signal_handler(getattr(signal, name), functools.partial(daemon.stop, name))
 
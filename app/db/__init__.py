@@ -1,3 +1,6 @@
+import functools
+
+@functools.lru_cache(maxsize=None)
 def get_backend(name):
     from importlib import import_module
     return import_module('{}.{}'.format(__name__, name), package=__name__)
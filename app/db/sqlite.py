@@ -1,30 +1,36 @@
 import os
+import json
 import sqlite3
 
 class _Database:
     def __enter__(self):
-        self.con = sqlite3.connect(self.db)
+        self.con = sqlite3.connect(self.db, detect_types=sqlite3.PARSE_COLNAMES)
         self.cur = self.con.cursor()
         return self
 
+    def commit(self):
+        self.con.commit()
+
     def __exit__(self, type, value, tb):
         self.con.commit()
         self.cur.close()
         self.con.close()
 
+def _create_scan_tables(con):
+    con.execute('create table if not exists hosts ('
+                'ip text primary key on conflict replace,'
+                'name text,'
+                'online boolean,'
+                'last_online text not null,'
+                'last_indexed text,'
+                'file_count integer,'
+                'size)')
+
 class _ScanDatabase(_Database):
     def __init__(self, db):
         self.db = db
         with sqlite3.connect(self.db) as con:
-            con = sqlite3.connect(self.db)
-            con.execute('create table if not exists hosts ('
-                        'ip text primary key on conflict replace,'
-                        'name text,'
-                        'online boolean,'
-                        'last_online text not null,'
-                        'last_indexed text,'
-                        'file_count integer,'
-                        'size)')
+            _create_scan_tables(con)
 
     def set_hosts(self, hosts):
         self.cur.execute('delete from hosts')
@@ -41,64 +47,304 @@ class _ScanDatabase(_Database):
         self.cur.executemany('insert into hosts values (?, ?, ?, ?, ?, ?, ?)', values)
 
     def get_hosts(self):
-        self.cur.execute('select ip, name, online, last_online, last_indexed,'
+        self.cur.execute('select ip, name, online,'
+                         'last_online as "last_online [timestamp]",'
+                         'last_indexed as "last_indexed [timestamp]",'
                          'file_count, size from hosts')
 
         return { ip: { 'name': n, 'online': o, 'last_online': l, 'last_indexed': i,
                        'file_count': f, 'size': s }
                  for (ip, n, o, l, i, f, s) in self.cur }
 
+def _create_index_tables(con):
+    # Files with the same name and size, usually copies of each other, share the
+    # same identity so that they can be grouped in search results.  Names and paths
+    # are stored once each, and their full-text indexes read them from these tables
+    # (external content) instead of keeping their own copy.
+    con.execute('create table if not exists identities ('
+                'id integer primary key,'
+                'name text not null,'
+                'size integer,'
+                'unique (name, size))')
+    con.execute('create table if not exists dirs ('
+                'id integer primary key,'
+                'path text not null unique)')
+    con.execute('create virtual table if not exists names using fts4('
+                'content="identities", name, tokenize=unicode61)')
+    con.execute('create virtual table if not exists paths using fts4('
+                'content="dirs", path, tokenize=unicode61)')
+
+    # Each walk of a host indexes its files under a new generation, which only
+    # replaces the current one once the walk is complete.
+    con.execute('create table if not exists files ('
+                'ip text not null,'
+                'dir integer not null,'
+                'identity integer not null,'
+                'generation integer not null)')
+    con.execute('create index if not exists files_ip on files (ip, generation)')
+    con.execute('create index if not exists files_dir on files (dir)')
+    con.execute('create index if not exists files_identity on files (identity)')
+    con.execute('create table if not exists generations ('
+                'ip text primary key on conflict replace,'
+                'generation integer not null)')
+
+# Condition on `files` rows for them to be part of the current index of their host
+_CURRENT = ('files.generation = coalesce((select g.generation from generations g '
+            'where g.ip = files.ip), 0)')
+
+# Condition on `files` rows for their name or directory to match a search term
+_MATCH = ('(files.identity in (select docid from names where names match ?) '
+          'or files.dir in (select docid from paths where paths match ?))')
+
+# Delete names and paths no longer used by any file.  Full-text indexes read the old
+# values from their content tables, so they must forget about them first.
+def _collect_garbage(cur):
+    for (table, fts, column) in [('identities', 'names', 'identity'),
+                                 ('dirs', 'paths', 'dir')]:
+        unused = 'select id from {} where id not in (select {} from files)'.format(
+            table, column)
+        cur.execute('delete from {} where docid in ({})'.format(fts, unused))
+        cur.execute('delete from {} where id in ({})'.format(table, unused))
+
 class _IndexDatabase(_Database):
     def __init__(self, db):
         self.db = db
         with sqlite3.connect(self.db) as con:
             # Enable WAL (https://www.sqlite.org/wal.html) to allow reads while writing.
             con.execute('pragma journal_mode=wal')
-            con.execute('create virtual table if not exists files using fts4('
-                        'path text,'
-                        'name text,'
-                        'ip text,'
-                        'size integer,'
-                        'notindexed=ip, notindexed=size, tokenize=unicode61)')
 
-    def delete(self, ip):
-        self.cur.execute('delete from files where ip=?', (ip,))
+            # Files used to be a full-text table holding their names and paths, with
+            # either their sizes or their identities.
+            old_layout = [sql for (sql,) in con.execute(
+                "select sql from sqlite_master where name = 'files' and sql like '%fts4%'")]
+            if old_layout:
+                con.execute('alter table files rename to files_old')
+
+            _create_index_tables(con)
+
+            if old_layout and 'identity' in old_layout[0]:
+                con.execute('insert or ignore into dirs (path) select path from files_old')
+                con.execute('insert into files '
+                            'select o.ip, d.id, o.identity, o.generation from files_old o '
+                            'join dirs d on d.path = o.path')
+            elif old_layout:
+                con.execute('insert or ignore into identities (name, size) '
+                            'select name, size from files_old')
+                con.execute('insert or ignore into dirs (path) select path from files_old')
+                con.execute('insert into files '
+                            'select o.ip, d.id, i.id, 0 from files_old o '
+                            'join identities i on i.name = o.name and i.size is o.size '
+                            'join dirs d on d.path = o.path')
+            if old_layout:
+                con.execute("insert into names (names) values ('rebuild')")
+                con.execute("insert into paths (paths) values ('rebuild')")
+                con.execute('drop table files_old')
+
+            con.execute('create table if not exists checkpoints ('
+                        'ip text primary key on conflict replace,'
+                        'generation integer not null,'
+                        'todo text not null)')
+
+    # Return the generation for a new walk of a host and drop what previous walks may
+    # have left unfinished.
+    def new_generation(self, ip):
+        self.cur.execute('select generation from generations where ip = ?', (ip,))
+        row = self.cur.fetchone()
+        current = 0 if row is None else row[0]
+        self.cur.execute('delete from files where ip = ? and generation != ?',
+                         (ip, current))
+        return current + 1
+
+    # Make a generation the current index of a host once its walk is complete.
+    def finish(self, ip, generation):
+        self.cur.execute('delete from files where ip = ? and generation != ?',
+                         (ip, generation))
+        self.cur.execute('insert into generations values (?, ?)', (ip, generation))
+        self.cur.execute('delete from checkpoints where ip = ?', (ip,))
 
     def prune(self, hosts_to_keep):
         set_param = '({})'.format(','.join('?' * len(hosts_to_keep)))
         query = 'delete from files where ip not in {}'.format(set_param)
         self.cur.execute(query, hosts_to_keep)
+        query = 'delete from checkpoints where ip not in {}'.format(set_param)
+        self.cur.execute(query, hosts_to_keep)
+        query = 'delete from generations where ip not in {}'.format(set_param)
+        self.cur.execute(query, hosts_to_keep)
+        _collect_garbage(self.cur)
+
+    def __enter__(self):
+        super().__enter__()
+        # Created here as the sqlite3 module of Python < 3.6 commits before any DDL.
+        self.cur.execute('create temp table new_files (path text, name text, size integer)')
+        return self
+
+    # Files go through a temporary table so that their names and paths are looked up
+    # with a few statements per call (i.e. per directory) instead of per file.
+    def index(self, ip, generation, files):
+        try:
+            self.cur.executemany('insert into new_files values (?, ?, ?)', files)
+        finally:
+            # Files read before an error (e.g. BadEncoding) are indexed as well.
+            for (table, fts, columns) in [('identities', 'names', 'name, size'),
+                                          ('dirs', 'paths', 'path')]:
+                self.cur.execute('select coalesce(max(id), 0) from {}'.format(table))
+                (last_id,) = self.cur.fetchone()
+                self.cur.execute('insert or ignore into {0} ({1}) '
+                                 'select distinct {1} from new_files'
+                                 .format(table, columns))
+                column = columns.split(',')[0]
+                self.cur.execute('insert into {0} (docid, {1}) '
+                                 'select id, {1} from {2} where id > ?'
+                                 .format(fts, column, table), (last_id,))
+            self.cur.execute('insert into files '
+                             'select ?, d.id, i.id, ? from new_files n '
+                             'join identities i on i.name = n.name and i.size = n.size '
+                             'join dirs d on d.path = n.path',
+                             (ip, generation))
+            self.cur.execute('delete from new_files')
 
-    def index(self, ip, files):
-        self.cur.executemany('insert into files values (?, ?, ?, ?)',
-                ((path, name, ip, size) for (path, name, size) in files))
+    def set_checkpoint(self, ip, generation, todo):
+        self.cur.execute('insert into checkpoints values (?, ?, ?)',
+                         (ip, generation, json.dumps(todo)))
 
+    # Return the generation and the directories left to list of an unfinished walk.
+    def get_checkpoint(self, ip):
+        self.cur.execute('select generation, todo from checkpoints where ip = ?', (ip,))
+        row = self.cur.fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def get_checkpoints(self):
+        self.cur.execute('select ip from checkpoints')
+        return [ip for (ip,) in self.cur]
+
+    # Return one hit per identity, with all its matching copies.  The limit applies to
+    # identities and not to copies.  A file matches if each term is found in its name
+    # or in the path of its directory.
     def search(self, terms, hosts, limit=None):
-        match_param = ' '.join(terms)
+        terms = [term for term in terms if term]
+        if not terms or not hosts: return []
         limit_param = limit is None and -1 or limit
+        term_bindings = tuple(t for term in terms for t in (term, term))
+        conditions = ' and '.join(['files.ip in ({})'.format(','.join('?' * len(hosts))),
+                                   _CURRENT] + [_MATCH] * len(terms))
 
-        query = '''select path, name, ip, size from files
-                   where files match ? and ip in ({})
-                   limit ?'''.format(','.join('?' * len(hosts)))
-        bindings = (match_param,) + tuple(hosts) + (limit_param,)
+        # Identities are looked up from the files matching the first term, and these
+        # files are then filtered with all the conditions.
+        query = '''select distinct files.identity from (
+                       select rowid as id from files where identity in (
+                           select docid from names where names match ?)
+                       union
+                       select rowid from files where dir in (
+                           select docid from paths where paths match ?)) m
+                   cross join files on files.rowid = m.id
+                   where {} limit ?'''.format(conditions)
+        self.cur.execute(query, (terms[0], terms[0]) + tuple(hosts) + term_bindings
+                                + (limit_param,))
+        identities = [i for (i,) in self.cur]
 
-        self.cur.execute(query, bindings)
+        query = '''select d.path, files.ip, i.id, i.name, i.size
+                   from files join identities i on i.id = files.identity
+                   join dirs d on d.id = files.dir
+                   where files.identity in ({}) and {}
+                   order by files.identity'''.format(','.join('?' * len(identities)),
+                                                      conditions)
+        self.cur.execute(query, tuple(identities) + tuple(hosts) + term_bindings)
 
-        return [{ 'path': p, 'name': n, 'host': hosts[ip], 'size': float(s) }
-                for (p, n, ip, s) in self.cur]
+        hits = {}
+        for (p, ip, i, n, s) in self.cur:
+            hit = hits.setdefault(i, { 'name': n, 'size': float(s), 'copies': [] })
+            hit['copies'].append({ 'path': p, 'host': hosts[ip] })
+        return [hits[i] for i in identities]
 
     def get_stat(self, ip):
-        self.cur.execute('select count(*), sum(size) from files where ip = ?', (ip,))
+        self.cur.execute('select count(*), sum(i.size) from files '
+                         'join identities i on i.id = files.identity '
+                         'where files.ip = ? and {}'.format(_CURRENT), (ip,))
         ((file_count, size),) = self.cur
         return { 'file_count': file_count, 'size': size }
 
+# The replica holds both the hosts and the index, so that it is all a web server needs.
+class _ReplicaDatabase(_IndexDatabase, _ScanDatabase):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        # The replica is only ever replaced as a whole by the daemon, never modified.
+        self.con = sqlite3.connect('file:{}?mode=ro'.format(self.db), uri=True,
+                                   detect_types=sqlite3.PARSE_COLNAMES)
+        self.cur = self.con.cursor()
+        return self
+
+def _publish(scan_file, index_file, replica_file):
+    tmp_file = '{}.tmp'.format(replica_file)
+    if os.path.exists(tmp_file): os.remove(tmp_file)
+
+    # Make sure that the tables to copy exist.
+    (_ScanDatabase(scan_file), _IndexDatabase(index_file))
+
+    # The copy is made with plain SQL since the online backup API is only available
+    # from Python 3.7.  It uses the default journal mode (no WAL) so that it can be
+    # read without write access and shipped to other web servers as is.
+    con = sqlite3.connect(tmp_file, isolation_level=None)
+    try:
+        _create_scan_tables(con)
+        _create_index_tables(con)
+        con.execute('attach database ? as live', (index_file,))
+
+        # Reading the index in a single transaction gives a consistent snapshot even
+        # if a walker commits in the meantime.
+        con.execute('begin')
+        con.execute('insert into generations select * from live.generations')
+        con.execute('insert into files select * from live.files files '
+                    'where {}'.format(_CURRENT))
+        con.execute('insert into identities select * from live.identities '
+                    'where id in (select identity from files)')
+        con.execute('insert into dirs select * from live.dirs '
+                    'where id in (select dir from files)')
+        con.execute('commit')
+        con.execute('detach database live')
+
+        # Build the full-text indexes from the copied names and paths.
+        con.execute("insert into names (names) values ('rebuild')")
+        con.execute("insert into paths (paths) values ('rebuild')")
+
+        # The scan database is not in WAL mode: it is read in its own short transaction
+        # so that the daemon is not prevented from updating it while the index is copied.
+        con.execute('attach database ? as scan', (scan_file,))
+        con.execute('insert into hosts select * from scan.hosts')
+        con.execute('detach database scan')
+
+        # Merge FTS segments to speed up searches.
+        con.execute("insert into names (names) values ('optimize')")
+        con.execute("insert into paths (paths) values ('optimize')")
+    finally:
+        con.close()
+
+    # Connections opened before the switch keep reading the old file.
+    os.replace(tmp_file, replica_file)
+
 class Store:
     def __init__(self, conf):
         self.scan_file = conf['scan_file']
         self.index_file = conf['index_file']
+        self.replica_file = conf.get('replica_file', None)
 
     def scan_db(self):
         return _ScanDatabase(self.scan_file)
 
     def index_db(self):
         return _IndexDatabase(self.index_file)
+
+    def _has_replica(self):
+        return self.replica_file is not None and os.path.exists(self.replica_file)
+
+    def hosts_db(self):
+        return _ReplicaDatabase(self.replica_file) if self._has_replica() \
+                else self.scan_db()
+
+    def search_db(self):
+        return _ReplicaDatabase(self.replica_file) if self._has_replica() \
+                else self.index_db()
+
+    def publish(self):
+        _publish(self.scan_file, self.index_file, self.replica_file)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Subsystems are only imported by the commands using them, so that the CLI starts
+# quickly from cron jobs and shells.
+
+import sys
+import argparse
+
+def get_conf():
+    import local_settings as conf
+    return conf
+
+def get_store(conf):
+    from db import get_backend
+    return get_backend(conf.STORE['NAME']).Store(conf.STORE['CONF'])
+
+def setup_logging(conf):
+    import logging.config
+    logging.config.dictConfig(conf.LOGGING)
+
+def get_scanner(conf, loop):
+    from scanner import Scanner
+    return Scanner(loop, port=conf.PORT, user=conf.USER, passwd=conf.PASSWD,
+                   timeout=conf.SCAN_TIMEOUT, max_tasks=conf.MAX_SCAN_TASKS)
+
+def get_walker(conf, ip):
+    from walker import Walker
+    return Walker(ip, conf.PORT, conf.USER, conf.PASSWD, conf.INDEX_TIMEOUT,
+                  conf.MAX_INDEX_ERRORS, get_store(conf).index_db(),
+                  checkpoint_interval=conf.INDEX_CHECKPOINT_INTERVAL)
+
+def scan(args):
+    import asyncio
+
+    conf = get_conf()
+    setup_logging(conf)
+    loop = asyncio.get_event_loop()
+    scanner = get_scanner(conf, loop)
+    try:
+        hosts = loop.run_until_complete(scanner.scan(args.network or conf.NETWORK))
+    finally:
+        loop.close()
+    for (ip, name) in sorted(hosts):
+        print('{}\t{}'.format(ip, name))
+
+def walk(args):
+    import socket
+
+    conf = get_conf()
+    setup_logging(conf)
+    ip = socket.gethostbyname(args.host)
+    get_walker(conf, ip).walk()
+
+def search(args):
+    import os
+    import searcher
+
+    conf = get_conf()
+    hits = searcher.search(get_store(conf), ' '.join(args.query), online=args.online,
+                           limit=args.limit)
+    for hit in hits:
+        for copy in hit['copies']:
+            print('{}\t{}\t{:.0f}'.format(copy['host']['name'],
+                                          os.path.join(copy['path'], hit['name']),
+                                          hit['size']))
+
+def serve(args):
+    from web import app
+    app.debug = args.debug
+    app.run(host=args.host, port=args.port)
+
+def _run_time(code, repeat):
+    import time
+    import subprocess
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+# Code run in a fresh interpreter for each command: everything the command does up to
+# its first network access, with the store replaced by an empty one.
+_BENCH_SETUP = '''
+import local_settings as conf
+conf.STORE = {{ 'NAME': 'sqlite', 'CONF': {{ 'scan_file': {scan_file!r},
+                                           'index_file': {index_file!r} }} }}
+import porygon
+args = porygon.parse_args({argv!r})
+'''
+
+_BENCH_COMMANDS = [
+    ('search', ['search', 'x'], 'porygon.main({argv!r})'),
+    ('walk', ['walk', '127.0.0.1'], 'porygon.get_walker(conf, args.host)'),
+    ('scan', ['scan'],
+     'import asyncio; porygon.get_scanner(conf, asyncio.get_event_loop())'),
+]
+
+# Measure startup times of commands in fresh interpreters, relative to a bare
+# interpreter, and fail if one of them exceeds STARTUP_BUDGET.
+def bench(args):
+    import os
+    import time
+    import tempfile
+    import subprocess
+
+    conf = get_conf()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    baseline = _run_time('pass', args.repeat)
+    print('interpreter\t{:.1f} ms'.format(baseline * 1000))
+
+    over_budget = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = { 'scan_file': os.path.join(tmp_dir, 'scan.db'),
+                  'index_file': os.path.join(tmp_dir, 'index.db') }
+
+        # Create the databases beforehand, as it is not part of the startup.
+        from db import get_backend
+        store = get_backend('sqlite').Store(files)
+        with store.scan_db(), store.index_db(): pass
+
+        for (name, argv, code) in _BENCH_COMMANDS:
+            code = _BENCH_SETUP.format(argv=argv, **files) + code.format(argv=argv)
+            try:
+                duration = _run_time(code, args.repeat) - baseline
+            except subprocess.CalledProcessError:
+                print('{}\tfailed'.format(name))
+                over_budget = True
+            else:
+                print('{}\t{:.1f} ms'.format(name, duration * 1000))
+                over_budget |= duration > conf.STARTUP_BUDGET
+
+    if args.query:
+        import searcher
+        store = get_store(conf)
+        start = time.perf_counter()
+        hits = searcher.search(store, ' '.join(args.query), limit=100)
+        duration = time.perf_counter() - start
+        print('search\t{:.1f} ms ({} hits)'.format(duration * 1000, len(hits)))
+
+    if over_budget:
+        print('Startup of some commands exceeds the budget of {:.1f} ms or failed'
+              .format(conf.STARTUP_BUDGET * 1000))
+        return 1
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='porygon', description='FTP indexer')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('scan', help='scan the network for FTP servers')
+    cmd.add_argument('network', nargs='?', help='network to scan (default: NETWORK)')
+    cmd.set_defaults(func=scan)
+
+    cmd = commands.add_parser('walk', help='index an FTP server')
+    cmd.add_argument('host')
+    cmd.set_defaults(func=walk)
+
+    cmd = commands.add_parser('search', help='search the index')
+    cmd.add_argument('query', nargs='+')
+    cmd.add_argument('--online', action='store_true', help='only online servers')
+    cmd.add_argument('--limit', type=int, default=100)
+    cmd.set_defaults(func=search)
+
+    cmd = commands.add_parser('serve', help='run the web interface')
+    cmd.add_argument('--host', default='0.0.0.0')
+    cmd.add_argument('--port', type=int, default=5000)
+    cmd.add_argument('--debug', action='store_true')
+    cmd.set_defaults(func=serve)
+
+    cmd = commands.add_parser('bench', help='measure startup and search times')
+    cmd.add_argument('query', nargs='*', help='also time a search for this query')
+    cmd.add_argument('--repeat', type=int, default=5)
+    cmd.set_defaults(func=bench)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
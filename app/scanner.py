@@ -1,8 +1,5 @@
-#!/usr/bin/env python3
-
 import asyncio
 import logging
-from datetime import datetime
 from limiter import JoinableSemaphore
 from ipaddress import IPv4Address, ip_network
 
@@ -96,18 +93,3 @@ class Scanner():
         yield from self.limiter.join() # wait for all tasks to finish
         logger.info('Finished scan of %s, found: %s', network, self.ftp_hosts)
         return self.ftp_hosts
-
-if __name__ == '__main__':
-    # Testing
-    import sys
-    import local_settings as conf
-    import logging.config
-    network = sys.argv[1]
-    logging.config.dictConfig(conf.LOGGING)
-
-    start_time = datetime.utcnow()
-    loop = asyncio.get_event_loop()
-    scanner = Scanner(loop, port=conf.PORT, user=conf.USER, passwd=conf.PASSWD,
-                      timeout=conf.SCAN_TIMEOUT, max_tasks=conf.MAX_SCAN_TASKS)
-    ftps = loop.run_until_complete(scanner.scan(network))
-    loop.close()
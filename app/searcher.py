@@ -0,0 +1,18 @@
+import re
+
+def get_terms(query):
+    from slugify import slugify
+
+    # Normalize terms and then make sure they only contain alphanumeric characters
+    simple_terms = slugify(query, separator=' ').split(' ')
+    return [re.sub(r'[^a-zA-Z0-9]+', '', term) for term in simple_terms]
+
+def search(store, query, online=False, limit=None):
+    with store.hosts_db() as db:
+        hosts = db.get_hosts()
+
+    if online:
+        hosts = { ip: info for (ip, info) in hosts.items() if info['online'] }
+
+    with store.search_db() as db:
+        return db.search(get_terms(query), hosts, limit=limit)
@@ -25,5 +25,30 @@ INDEX_INTERVAL = 4 * 3600
 # Maximum number of FTP errors allowed during the indexation of a server
 MAX_INDEX_ERRORS = 10
 
+# Delay before resuming an index task that failed (e.g. the server went away), from
+# its last checkpoint
+INDEX_RETRY_INTERVAL = 10 * 60
+
+# Maximum duration of an index task before it is paused to let other servers be
+# indexed (None for no limit)
+INDEX_BUDGET_DURATION = 30 * 60
+
+# Maximum number of directories listed by an index task before it is paused (None for
+# no limit)
+INDEX_BUDGET_DIRS = 10000
+
+# Interval between two checkpoints of an index task, from which it is resumed if it
+# gets interrupted (None to only checkpoint when the task ends)
+INDEX_CHECKPOINT_INTERVAL = 60
+
+# Interval between two publications of the replica of the servers and of the index
+# read by the web interface (only if 'replica_file' is set in the store configuration)
+REPLICA_INTERVAL = 5 * 60
+
+# Maximum startup time of each command of the command line interface, on top of the
+# interpreter's, as checked by `porygon.py bench` (`search` alone needs about 40 ms
+# on a laptop to import argparse, slugify and sqlite3)
+STARTUP_BUDGET = 0.1
+
 # Signals to catch
 SOFT_SIGNALS = ['SIGINT', 'SIGTERM']
@@ -1,9 +1,6 @@
-#!/usr/bin/env python3
-
 import os
-import ftplib
+import time
 import logging
-import logging.config
 
 class TooManyErrors(Exception):
     pass
@@ -21,29 +18,81 @@ def _(latin1_string):
         raise BadEncoding(latin1_string)
 
 class Walker():
-    def __init__(self, ip, port, user, passwd, timeout, max_errors, db):
+    def __init__(self, ip, port, user, passwd, timeout, max_errors, db,
+                 max_duration=None, max_dirs=None, checkpoint_interval=None):
         self.ip = ip
         self.logger = logging.getLogger('Walker({})'.format(ip))
         self.conn = Connection(ip, port, user, passwd, timeout, self.logger, max_errors)
         self.db = db
+        self.max_duration = max_duration
+        self.max_dirs = max_dirs
+        self.checkpoint_interval = checkpoint_interval
+        self.should_stop = False
+
+        self.generation = None # generation of the index being built
+        self.todo = None # directories left to list
+
+    def _has_budget(self, start, dir_count):
+        if self.max_dirs is not None and dir_count >= self.max_dirs:
+            return False
+        if self.max_duration is not None and time.monotonic() - start >= self.max_duration:
+            return False
+        return True
+
+    # Commit what has been indexed so far along with the directories left to list, so
+    # that a walk interrupted for any reason resumes from there instead of ''.  The
+    # previous index of the host remains the one searched until the walk is complete.
+    def _checkpoint(self):
+        if self.todo:
+            self.db.set_checkpoint(self.ip, self.generation, self.todo)
+        else:
+            self.db.finish(self.ip, self.generation)
+        self.db.commit()
 
-        self.todo = ['']
+    # Can be called from another thread.
+    def stop(self):
+        self.should_stop = True
 
+    # Return True if the walk is complete and False if it was stopped or ran out of
+    # budget.  In the latter case, the next walk of this host resumes this one.
     def walk(self):
+        (start, dir_count) = (time.monotonic(), 0)
+        last_checkpoint = start
         with self.db:
-            self.db.delete(self.ip)
-            while True:
-                try: path, *self.todo = self.todo
-                except ValueError: break # run until todo is empty
-                (files, dirs) = self.conn.ls(path)
-                self.todo += dirs
-
-                file_info = ((_(path), _(name), size) for (path, name, size) in files)
-
-                try:
-                    self.db.index(self.ip, file_info)
-                except BadEncoding as exc:
-                    self.logger.warn('Bad encoding in %s: %s', path, exc.args[0])
+            checkpoint = self.db.get_checkpoint(self.ip)
+            if checkpoint is None:
+                self.generation = self.db.new_generation(self.ip)
+                self.todo = ['']
+            else:
+                (self.generation, self.todo) = checkpoint
+                self.logger.info('Resuming walk, %d directories left', len(self.todo))
+            try:
+                while self.todo:
+                    if self.should_stop or not self._has_budget(start, dir_count):
+                        self.logger.info('Pausing walk, %d directories left',
+                                         len(self.todo))
+                        return False
+                    path = self.todo[0]
+                    (files, dirs) = self.conn.ls(path)
+
+                    file_info = ((_(path), _(name), size) for (path, name, size) in files)
+
+                    try:
+                        self.db.index(self.ip, self.generation, file_info)
+                    except BadEncoding as exc:
+                        self.logger.warn('Bad encoding in %s: %s', path, exc.args[0])
+
+                    # Only forget about a directory once its files are indexed.
+                    self.todo = self.todo[1:] + dirs
+                    dir_count += 1
+
+                    if self.checkpoint_interval is not None \
+                            and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        self._checkpoint()
+                        last_checkpoint = time.monotonic()
+            finally:
+                self._checkpoint()
+        return True
 
 class Connection():
     def __init__(self, ip, port, user, passwd, timeout, logger, max_errors=0):
@@ -57,7 +106,10 @@ class Connection():
         self.mlsd_support = None
         self.ftp = None
 
+    # ftplib is only imported once connecting, as it pulls in ssl which is slow to
+    # import and would delay the startup of `porygon.py walk`.
     def _get_conn(self):
+        import ftplib
         if self.ftp is not None: return self.ftp
         self.ftp = ftplib.FTP()
         try:
@@ -94,6 +146,7 @@ class Connection():
         return (files, dirs)
 
     def ls(self, path):
+        import ftplib
         ftp = self._get_conn()
         try:
             if self.mlsd_support or self.mlsd_support is None:
@@ -110,19 +163,3 @@ class Connection():
             return self.ls(path)
         else:
             return self._handle_mlsd(path, listing)
-
-if __name__ == '__main__':
-    import sys
-    import socket
-    import local_settings as conf
-    from store import get_backend
-
-    host = sys.argv[1]
-
-    logging.config.dictConfig(conf.LOGGING)
-    store = get_backend(conf.BACKEND['NAME']).Store(conf.BACKEND['CONF'])
-    ip = socket.gethostbyname(host)
-    walker = Walker(host, conf.PORT, user='rez', passwd='rez',
-                    timeout=conf.INDEX_TIMEOUT, max_errors=conf.MAX_INDEX_ERRORS,
-                    store=self.store.index_db())
-    walker.walk()
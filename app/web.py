@@ -1,15 +1,19 @@
 # encoding: utf-8
 
 import os
-import re
-import arrow
-from slugify import slugify
+import functools
 from flask import Flask, render_template, request, url_for, redirect
 app = Flask(__name__)
 
 from db import get_backend
+import searcher
 import local_settings as conf
 
+# The store only holds the configuration, it can be shared by all requests.
+@functools.lru_cache(maxsize=None)
+def get_store():
+    return get_backend(conf.STORE['NAME']).Store(conf.STORE['CONF'])
+
 def format_size(num):
     if num is None:
         return None
@@ -28,12 +32,11 @@ def humanize(date):
     if date is None:
         return None
 
+    import arrow
     return arrow.get(date).humanize(locale='fr')
 
 def get_servers():
-    store = get_backend(conf.STORE['NAME']).Store(conf.STORE['CONF'])
-
-    with store.scan_db() as db:
+    with get_store().hosts_db() as db:
         hosts = db.get_hosts()
 
     return [{ 'name': info['name'], 'url': url_of(info['name']),
@@ -51,26 +54,16 @@ def search():
     if query == '': return redirect(url_for('home'))
 
     online = request.args.get('online', 'off') == 'on'
-
-    # Normalize terms and then make sure they only contain alphanumeric characters
-    simple_terms = slugify(query, separator=' ').split(' ')
-    safe_terms = [re.sub(r'[^a-zA-Z0-9]+', '', term) for term in simple_terms]
-
-    store = get_backend(conf.STORE['NAME']).Store(conf.STORE['CONF'])
-
-    with store.scan_db() as db:
-        hosts = db.get_hosts()
-
-    if online:
-        hosts = { ip: info for (ip, info) in hosts.items() if info['online'] }
-
-    with store.index_db() as db:
-        hits = db.search(safe_terms, hosts, limit=100)
+    hits = searcher.search(get_store(), query, online=online, limit=100)
 
     for hit in hits:
         hit['size'] = format_size(hit['size'])
-        hit['url'] = url_of(hit['host']['name'], os.path.join(hit['path'], hit['name']))
-        hit['dir_url'] = url_of(hit['host']['name'], os.path.join(hit['path']))
+        hit['copies'].sort(key=lambda copy: not copy['host']['online'])
+        for copy in hit['copies']:
+            copy['url'] = url_of(copy['host']['name'],
+                                 os.path.join(copy['path'], hit['name']))
+            copy['dir_url'] = url_of(copy['host']['name'], os.path.join(copy['path']))
+        hit['online'] = hit['copies'][0]['host']['online']
 
     return render_template('search.html', hits=hits, query=query, online=online)
 